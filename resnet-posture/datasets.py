@@ -58,8 +58,7 @@ class CocoKeypoints(VisionDataset):
         """
         coco = self.coco
         img_id = self.ids[index]
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        target = coco.loadAnns(ann_ids)
+        target, bbox = self.load_annotations(index)
 
         path = coco.loadImgs(img_id)[0]['file_name']
         image = Image.open(os.path.join(self.root, path)).convert('RGB')
@@ -70,18 +69,55 @@ class CocoKeypoints(VisionDataset):
             transforms.ToTensor()
         ])
 
-        # Extract bounding box
-        if len(target) > 0:
-            bbox = torch.tensor(target[0]['bbox'])
+        # Crop bounding box
+        if bbox is not None:
             x, y, w, h = bbox
-            x, y, w, h = int(x), int(y), int(w), int(h)
-
             image = image.crop((x, y, x + w, y + h))
-            image_shape = tuple(transforms.ToTensor()(image).shape[1:3])
 
         # Transform image
         img = self.transform(image)
 
+        return img, self.get_target(index)
+
+    def load_annotations(self, index):
+        """
+        Args:
+            index (int): Index
+
+        Returns:
+            tuple: Tuple (target, bbox). target is the object returned by
+                   ``coco.loadAnns`` and bbox the integer (x, y, w, h) box
+                   of its first annotation (None without annotations).
+        """
+        coco = self.coco
+        img_id = self.ids[index]
+        ann_ids = coco.getAnnIds(imgIds=img_id)
+        target = coco.loadAnns(ann_ids)
+
+        # Extract bounding box
+        bbox = None
+        if len(target) > 0:
+            x, y, w, h = target[0]['bbox']
+            bbox = int(x), int(y), int(w), int(h)
+
+        return target, bbox
+
+    def get_target(self, index):
+        """
+        Args:
+            index (int): Index
+
+        Returns:
+            tensor: keypoints heatmaps of the image, computed from the
+                    annotations only (the image is not read).
+        """
+        target, bbox = self.load_annotations(index)
+
+        # The cropped image has the size of the bounding box
+        if bbox is not None:
+            x, y, w, h = bbox
+            image_shape = (h, w)
+
         # Exctract keypoints
         keypoints = torch.tensor(target[0]['keypoints'])
         keypoints = keypoints.reshape(17, 3)
@@ -105,7 +141,7 @@ class CocoKeypoints(VisionDataset):
         trgt, trgt_weight = self.generate_target(keypoints)
         target_torch = torch.tensor(trgt)
 
-        return img, target_torch
+        return target_torch
 
     def __len__(self):
         return len(self.ids)
@@ -169,3 +205,48 @@ class CocoKeypoints(VisionDataset):
                         g[g_x[0]:g_x[1], g_y[0]:g_y[1]]
 
         return target, target_weight
+
+
+def unwrap_subset(dataset):
+    """Original dataset of (nested) subsets, with the map of indices to it."""
+    indices = None
+    while isinstance(dataset, torch.utils.data.Subset):
+        if indices is None:
+            indices = list(dataset.indices)
+        else:
+            indices = [dataset.indices[i] for i in indices]
+        dataset = dataset.dataset
+    return dataset, indices
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """Precomputed resnet features of a ``CocoKeypoints`` dataset.
+
+    Args:
+        dataset (Dataset): ``CocoKeypoints`` dataset (or a subset of it),
+            used to read the targets.
+        path (string): Path to the ``.npy`` file with the features of every
+            element of the original ``CocoKeypoints`` dataset.
+    """
+
+    def __init__(self, dataset, path):
+        self.dataset = dataset
+        self.path = path
+        self.features = None
+        self.original, self.indices = unwrap_subset(dataset)
+
+    def __getitem__(self, index):
+        # Find the index on the original dataset
+        if self.indices is not None:
+            index = self.indices[index]
+
+        # Memory map lazily, so each worker opens its own file
+        if self.features is None:
+            self.features = np.load(self.path, mmap_mode='r')
+        features = torch.from_numpy(np.array(self.features[index],
+                                             dtype=np.float32))
+
+        return features, self.original.get_target(index)
+
+    def __len__(self):
+        return len(self.dataset)
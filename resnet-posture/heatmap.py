@@ -20,15 +20,11 @@ def make_image(img, mean=(0,0,0), std=(1,1,1)):
 def gauss(x,a,b,c):
     return torch.exp(-torch.pow(torch.add(x,-b),2).div(2*c*c)).mul(a)
 
-def heatmap(x):
-    heatmap = torch.zeros((x.shape[0], 3,
-                           x.shape[2],
-                           x.shape[3]))
-    for idx in range(x.shape[0]):
-        heatmap[idx] = colorize(x[idx])
-    return heatmap
-
-def colorize(x):
+def heatmap(x, out=None):
+    # Colorize the whole batch at once, on the device of x
+    return colorize(x, out=out)
+
+def colorize(x, out=None):
     ''' Converts a one-channel grayscale image to a color heatmap image '''
     if x.dim() == 2:
         torch.unsqueeze(x, 0, out=x)
@@ -39,10 +35,15 @@ def colorize(x):
         cl[2] = gauss(x,1,.2,.3)
         cl[cl.gt(1)] = 1
     elif x.dim() == 4:
-        cl = torch.zeros([x.size(0), 3, x.size(2), x.size(3)])
+        x = x[:,0,:,:]
+        cl = out
+        if cl is None:
+            cl = torch.empty([x.size(0), 3, x.size(1), x.size(2)],
+                             dtype=x.dtype, device=x.device)
         cl[:,0,:,:] = gauss(x,.5,.6,.2) + gauss(x,1,.8,.3)
         cl[:,1,:,:] = gauss(x,1,.5,.3)
         cl[:,2,:,:] = gauss(x,1,.2,.3)
+        cl.clamp_(max=1)
     return cl
 
 def show_batch(images, Mean=(2, 2, 2), Std=(0.5,0.5,0.5)):
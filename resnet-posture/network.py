@@ -10,8 +10,10 @@ class Resnet_Posture(nn.Module):
 
         # Parameters
         self.image_shape = args.image_shape
+        self.cached_features = args.cache_features
 
         # Resnet
+        self.backbone = 'resnet50'
         self.resnet = models.resnet50(pretrained=True)
 
         # Deconv
@@ -26,7 +28,14 @@ class Resnet_Posture(nn.Module):
             nn.ReLU()
         )
 
-    def forward(self, x):
+    def train(self, mode=True):
+        super(Resnet_Posture, self).train(mode)
+
+        # Pretrained resnet is frozen, keep batchnorm statistics
+        self.resnet.eval()
+        return self
+
+    def features(self, x):
         x = self.resnet.conv1(x)
         x = self.resnet.bn1(x)
         x = self.resnet.relu(x)
@@ -35,8 +44,20 @@ class Resnet_Posture(nn.Module):
         x = self.resnet.layer2(x)
         x = self.resnet.layer3(x)
         x = self.resnet.layer4(x)
+
+        return x
+
+    def head(self, x):
         x = self.deconv1(x)
         x = self.deconv2(x)
         x = self.deconv3(x)
 
         return x
+
+    def forward(self, x):
+        # Inputs are resnet features when they were precomputed
+        if not self.cached_features:
+            x = self.features(x)
+        x = self.head(x)
+
+        return x
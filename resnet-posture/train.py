@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+import os
+import copy
 import argparse
+import threading
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.optim as optim
@@ -15,6 +19,16 @@ from utils import *
 from imshow import *
 from heatmap import heatmap
 
+
+def default_workers():
+    # Half of the cpus this process may run on, at most 8
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return min(8, cpus // 2)
+
+
 # Parser arguments
 parser = argparse.ArgumentParser(description='Train Resnet Posture estimation')
 parser.add_argument('--train-percentage', '--t',
@@ -27,9 +41,17 @@ parser.add_argument('--log-interval', '--li',
                     type=int, default=50, metavar='N',
                     help='how many batches to wait' +
                          'before logging training status')
+parser.add_argument('--valid-interval', '--vi',
+                    type=int, default=None, metavar='N',
+                    help='how many logging intervals to wait '
+                         'before validating (default: once per epoch)')
 parser.add_argument('--epochs', '--e',
                     type=int, default=2, metavar='N',
                     help='number of epochs to train (default: 2)')
+parser.add_argument('--num-workers', '--nw',
+                    type=int, default=default_workers(), metavar='N',
+                    help='number of dataloader worker processes '
+                         '(default: half of the usable cpus, at most 8)')
 parser.add_argument('--device', '--d',
                     default='cpu', choices=['cpu', 'cuda'],
                     help='pick device to run the training (defalut: "cpu")')
@@ -69,31 +91,52 @@ parser.add_argument('--plot', '--p',
 parser.add_argument('--summary', '--sm',
                     action='store_true',
                     help='show summary of model')
+parser.add_argument('--verbose', '--v',
+                    action='store_true',
+                    help='print debugging information')
+parser.add_argument('--anomaly', '--an',
+                    action='store_true',
+                    help='enable autograd anomaly detection (debug only)')
+parser.add_argument('--cache-features', '--cf',
+                    action='store_true',
+                    help='cache the pretrained resnet features on disk '
+                         'and train only the head (no image overlays '
+                         'are logged)')
+parser.add_argument('--profile', '--pf',
+                    action='store_true',
+                    help='profile a few training steps into the '
+                         'tensorboard run (shows stream overlap)')
+parser.add_argument('--compile', '--cp',
+                    action='store_true',
+                    help='compile the network with torch.compile')
 args = parser.parse_args()
 
 
-def batch_status(batch_idx, inputs, outputs, targets,
-                 epoch, train_loader, loss, validset):
-    # Global step
-    global_step = batch_idx + len(train_loader) * epoch
-
-    # update running loss statistics
-    args.running_loss += loss.item()
-    args.train_loss += loss.item()
-
-    # Write tensorboard statistics
-    args.writer.add_scalar('Train/loss', loss.item(), global_step)
+def batch_status(state, batch_idx, inputs, outputs, targets,
+                 epoch, loss):
+    # update running loss statistics and global step
+    state.update(loss)
+    global_step = state.step
 
     # print every args.log_interval of batches
     if global_step % args.log_interval == 0:
-        # validate
-        vloss = validate(validset, log_info=True, global_step=global_step)
+        # Single copy of the loss to host
+        loss_value = loss.item()
+
+        # Write tensorboard statistics
+        with args.writer_lock:
+            args.writer.add_scalar('Train/loss', loss_value, global_step)
+
+        # validate every args.valid_interval logs
+        if global_step % (args.log_interval * args.valid_interval) == 0:
+            state.valid_loss = validate(log_info=True,
+                                        global_step=global_step)
 
         # Add to tensorboard
         add_tensorboard(inputs, targets, outputs, global_step, name='Train')
 
         # Process current checkpoint
-        process_checkpoint(loss.item(), global_step, args)
+        process_checkpoint(loss_value, global_step, state, args)
 
         print('Epoch : {} Batch : {} [{}/{} ({:.0f}%)]\n'
               '====> Run_Loss : {:.6f} Valid_Loss : {:.6f}'
@@ -101,56 +144,117 @@ def batch_status(batch_idx, inputs, outputs, targets,
                       args.batch_size * batch_idx,
                       args.dataset_size,
                       100. * batch_idx / args.dataloader_size,
-                      args.running_loss / args.log_interval,
-                      vloss),
+                      state.running_loss.item() / args.log_interval,
+                      state.valid_loss),
               end='\n\n')
 
-        args.running_loss = 0.0
+        state.running_loss.zero_()
 
-    # (compatibility issues) Pass all pending items to disk
-    args.writer.flush()
+        # (compatibility issues) Pass all pending items to disk
+        with args.writer_lock:
+            args.writer.flush()
 
 
 def add_tensorboard(inputs, targets, outputs, global_step, name='Train'):
     # Make targets and output slices
-    trgt_slice = targets.sum(dim=1, keepdim=True)
-    otpt_slice = outputs.sum(dim=1, keepdim=True)
+    trgt_slice = targets.detach().float().sum(dim=1, keepdim=True)
+    otpt_slice = outputs.detach().float().sum(dim=1, keepdim=True)
+
+    # Heatmaps are colorized on device, into buffers reused per tag
+    trgt_htmp = heatmap(trgt_slice,
+                        out=heatmap_buffer((name, 'trgt'), trgt_slice))
+    otpt_htmp = heatmap(otpt_slice,
+                        out=heatmap_buffer((name, 'otpt'), otpt_slice))
+
+    # Copy to host, images are made and written on a background thread
+    if args.cache_features:
+        inputs = None
+    else:
+        inputs = inputs.detach().float().cpu()
+
+    # Heatmap buffers are reused, the thread gets its own copy (also on cpu)
+    trgt_htmp = trgt_htmp.to('cpu', copy=True)
+    otpt_htmp = otpt_htmp.to('cpu', copy=True)
+
+    # Bound the queue, at most one write pending besides this one
+    wait_tensorboard(pending=1)
+    args.tensorboard_futures.append(args.tensorboard_pool.submit(
+        write_tensorboard, inputs,
+        trgt_slice.cpu(), otpt_slice.cpu(),
+        trgt_htmp, otpt_htmp,
+        global_step, name))
 
-    trgt_htmp = heatmap(trgt_slice).to(args.device)
-    otpt_htmp = heatmap(otpt_slice).to(args.device)
 
+def wait_tensorboard(pending=0):
+    # Wait for the oldest writes, raising their errors
+    while len(args.tensorboard_futures) > pending:
+        args.tensorboard_futures.pop(0).result()
+
+
+def heatmap_buffer(key, x):
+    # Allocate once on device, again only if the batch shape changes
+    shape = (x.shape[0], 3) + tuple(x.shape[2:])
+    buffer = args.heatmap_buffers.get(key)
+    if buffer is None or tuple(buffer.shape) != shape:
+        buffer = torch.empty(shape, dtype=torch.float, device=args.device)
+        args.heatmap_buffers[key] = buffer
+    return buffer
+
+
+def write_tensorboard(inputs, trgt_slice, otpt_slice, trgt_htmp, otpt_htmp,
+                      global_step, name='Train'):
     # Make grids
-    image_grid = make_grid(inputs, nrow=4, padding=2, pad_value=1)
     trgt_slice_grid = make_grid(trgt_slice, nrow=4, padding=2, pad_value=1)
     otpt_slice_grid = make_grid(otpt_slice, nrow=4, padding=2, pad_value=1)
     trgt_htmp_grid = make_grid(trgt_htmp, nrow=4, padding=2, pad_value=1)
     otpt_htmp_grid = make_grid(otpt_htmp, nrow=4, padding=2, pad_value=1)
 
-    # Create Heatmaps grid
-    args.writer.add_image('{}/gt'.format(name), trgt_htmp_grid, global_step)
-    args.writer.add_image('{}/gt_image'.format(name),
-                          image_grid + trgt_slice_grid, global_step)
-    args.writer.add_image('{}/pred'.format(name), otpt_htmp_grid, global_step)
-    args.writer.add_image('{}/pred_image'.format(name),
-                          image_grid + otpt_slice_grid, global_step)
+    with args.writer_lock:
+        # Create Heatmaps grid
+        args.writer.add_image('{}/gt'.format(name),
+                              trgt_htmp_grid, global_step)
+        args.writer.add_image('{}/pred'.format(name),
+                              otpt_htmp_grid, global_step)
+
+        # Inputs are resnet features, there is no image to draw on
+        if args.cache_features:
+            return
+
+        image_grid = make_grid(inputs, nrow=4, padding=2, pad_value=1)
 
+        args.writer.add_image('{}/gt_image'.format(name),
+                              image_grid + trgt_slice_grid, global_step)
+        args.writer.add_image('{}/pred_image'.format(name),
+                              image_grid + otpt_slice_grid, global_step)
 
-def train(trainset, validset):
+
+def train(trainset):
     # Create dataset loader
-    train_loader = torch.utils.data.DataLoader(trainset,
-                                               batch_size=args.batch_size,
-                                               shuffle=True,
-                                               num_workers=2,
-                                               drop_last=False)
+    train_loader = torch.utils.data.DataLoader(
+        trainset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_memory,
+        persistent_workers=args.persistent_workers,
+        prefetch_factor=args.prefetch_factor,
+        drop_last=False)
     args.dataset_size = len(train_loader.dataset)
     args.dataloader_size = len(train_loader)
 
-    # get some random training images
-    dataiter = iter(train_loader)
-    batch = dataiter.next()
-    images, targets = dataiter.next()
+    # By default validate once per epoch
+    if args.valid_interval is None:
+        args.valid_interval = max(1, args.dataloader_size // args.log_interval)
 
     if args.plot:
+        # get some training images (not cached features)
+        sampleset = trainset.dataset if args.cache_features else trainset
+        sample_loader = torch.utils.data.DataLoader(sampleset,
+                                                    batch_size=args.batch_size,
+                                                    shuffle=False,
+                                                    num_workers=0)
+        images, targets = next(iter(sample_loader))
+
         # Create images grid
         grid = make_grid(images, nrow=4, padding=2, pad_value=1)
 
@@ -160,14 +264,29 @@ def train(trainset, validset):
         imshow(grid)
 
         # save sample into tensorboard
-        args.writer.add_image('Sample', grid)
+        with args.writer_lock:
+            args.writer.add_image('Sample', grid)
+
+    # Loss scaler, only float16 mixed precision needs it
+    args.scaler = torch.amp.GradScaler(
+        'cuda', enabled=args.amp and args.amp_dtype == torch.float16)
+
+    # Parameters are updated during backward, unless the scaler has to
+    # check every gradient for inf/nan before skipping or taking the step
+    in_backward = not args.scaler.is_enabled()
 
     # Define optimizer
     if args.optimizer == 'adam':
-        args.optimizer = optim.Adam(args.net.parameters(),
-                                    lr=args.learning_rate)
+        optimizer = optim.Adam
     elif args.optimizer == 'sgd':
-        args.optimizer = optim.SGD(args.net.parameters(),
+        optimizer = optim.SGD
+
+    if in_backward:
+        args.optimizer = BackwardOptimizer(optimizer,
+                                           args.net.parameters(),
+                                           lr=args.learning_rate)
+    else:
+        args.optimizer = optimizer(args.net.parameters(),
                                    lr=args.learning_rate)
 
     # Set loss function
@@ -176,75 +295,122 @@ def train(trainset, validset):
     # restore checkpoint
     restore_checkpoint(args)
 
-    # Set best for minimization
-    args.best = float('inf')
+    # Checkpoints are written on a background thread
+    args.checkpoint_pool = ThreadPoolExecutor(max_workers=1)
+    args.checkpoint_futures = []
+
+    # Loss statistics, global step and best loss (for minimization)
+    state = TrainState(torch.zeros((), device=args.device),
+                       torch.zeros((), device=args.device))
+
+    # Profile a few steps, the trace shows whether the optimizer stream
+    # runs next to the backward kernels of the compute stream
+    profiler = None
+    if args.profile:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(args.device).type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=1, warmup=2, active=3,
+                                             repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                'runs/' + args.run))
+        profiler.start()
 
     print('Started Training')
     # loop over the dataset multiple times
     for epoch in range(args.epochs):
-        # reset running loss statistics
-        args.train_loss = args.train_acc = args.running_loss = 0.0
+        # reset epoch loss statistics
+        state.train_loss.zero_()
+
+        # Batches are sent to device by the prefetcher
+        prefetcher = CUDAPrefetcher(train_loader, args.device)
+        batch_idx = 0
+        while (batch := prefetcher.next()) is not None:
+            batch_idx += 1
 
-        for batch_idx, batch in enumerate(train_loader, 1):
             # Unpack batch
             inputs, targets = batch
 
-            # Send to device
-            inputs = inputs.to(args.device)
-            targets = targets.to(args.device)
+            # NHWC layout for tensor core convolutions
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
 
             # Calculate gradients and update
-            with autograd.detect_anomaly():
-                # zero the parameter gradients
-                args.optimizer.zero_grad()
-
-                # forward
+            # forward + calculate loss in mixed precision
+            with torch.amp.autocast('cuda', enabled=args.amp,
+                                    dtype=args.amp_dtype):
                 outputs = args.net(inputs)
-
-                # calculate loss
                 loss = args.criterion(outputs, targets)
 
-                # backward + step
-                loss.backward()
-                args.optimizer.step()
+            # backward on the (scaled) loss
+            args.scaler.scale(loss).backward()
+
+            if in_backward:
+                # each parameter was stepped and its gradient freed as
+                # soon as the gradient was ready
+                args.optimizer.wait()
+            else:
+                # single inf/nan check, the whole step is taken or skipped
+                args.scaler.step(args.optimizer)
+                args.scaler.update()
+                args.optimizer.zero_grad(set_to_none=True)
 
             # Log batch status
-            batch_status(batch_idx, inputs, outputs, targets,
-                         epoch, train_loader, loss, validset)
+            batch_status(state, batch_idx, inputs, outputs, targets,
+                         epoch, loss)
+
+            if profiler is not None:
+                profiler.step()
 
         print('Epoch: {} Average loss: {:.4f}'
-              .format(epoch, args.train_loss / len(train_loader)))
+              .format(epoch, state.train_loss.item() / len(train_loader)))
+
+    if profiler is not None:
+        profiler.stop()
+
+    # Wait for pending checkpoints
+    wait_checkpoints(args)
+    args.checkpoint_pool.shutdown(wait=True)
 
     # Add trained model
     print('Finished Training')
 
 
-def validate(validset, print_info=False, log_info=False, global_step=0):
-    # Create dataset loader
-    valid_loader = torch.utils.data.DataLoader(validset,
-                                               batch_size=args.batch_size,
-                                               shuffle=True,
-                                               drop_last=False)
+def validate(print_info=False, log_info=False, global_step=0):
+    # Dataset loader is created once in main
+    valid_loader = args.valid_loader
+
     if print_info:
         print('Started Validation')
 
+    # Evaluation mode, restore previous mode when finished
+    was_training = args.net.training
+    args.net.eval()
+
     run_loss = 0
-    for batch_idx, batch in enumerate(valid_loader, 1):
+    # Batches are sent to device by the prefetcher
+    prefetcher = CUDAPrefetcher(valid_loader, args.device)
+    batch_idx = 0
+    while (batch := prefetcher.next()) is not None:
+        batch_idx += 1
+
         # Unpack batch
         inputs, targets = batch
 
-        # Send to device
-        inputs = inputs.to(args.device)
-        targets = targets.to(args.device)
+        # NHWC layout for tensor core convolutions
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
 
-        # Calculate gradients and update
-        with autograd.detect_anomaly():
+        # Forward without autograd bookkeeping
+        with torch.inference_mode(), \
+             torch.amp.autocast('cuda', enabled=args.amp,
+                                dtype=args.amp_dtype):
             # forward
             outputs = args.net(inputs)
 
             # calculate loss
             loss = args.criterion(outputs, targets)
-            run_loss += loss.item()
+        run_loss += loss.item()
 
         if batch_idx == 1:
             # Add to tensorboard
@@ -252,9 +418,12 @@ def validate(validset, print_info=False, log_info=False, global_step=0):
                             global_step, name='Valid')
 
     if log_info:
-        args.writer.add_scalar('Valid/loss',
-                               run_loss / len(valid_loader),
-                               global_step)
+        with args.writer_lock:
+            args.writer.add_scalar('Valid/loss',
+                                   run_loss / len(valid_loader),
+                                   global_step)
+
+    args.net.train(was_training)
 
     return run_loss / len(valid_loader)
 
@@ -262,10 +431,15 @@ def validate(validset, print_info=False, log_info=False, global_step=0):
 def predict_test(testset):
     # Create dataset loader
     # Create dataset loader
-    test_loader = torch.utils.data.DataLoader(testset,
-                                              batch_size=args.batch_size,
-                                              shuffle=False,
-                                              drop_last=False)
+    test_loader = torch.utils.data.DataLoader(
+        testset,
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_memory,
+        persistent_workers=args.persistent_workers,
+        prefetch_factor=args.prefetch_factor,
+        drop_last=False)
 
     # restore checkpoint
     restore_checkpoint(args)
@@ -273,6 +447,9 @@ def predict_test(testset):
     # Set loss function
     args.criterion = torch.nn.MSELoss()
 
+    # To do inference
+    args.net.eval()
+
     # Predict all test elements and measure
     run_loss = 0
     for batch_idx, batch in enumerate(test_loader, 1):
@@ -280,34 +457,36 @@ def predict_test(testset):
         inputs, targets = batch
 
         # Send to device
-        inputs = inputs.to(args.device)
-        targets = targets.to(args.device)
-
-        # Calculate gradients and update
-        with autograd.detect_anomaly():
+        inputs = inputs.to(args.device, non_blocking=True)
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+        targets = targets.to(args.device, non_blocking=True)
+
+        # Forward without autograd bookkeeping
+        with torch.inference_mode(), \
+             torch.amp.autocast('cuda', enabled=args.amp,
+                                dtype=args.amp_dtype):
             # forward
             outputs = args.net(inputs)
 
             # get maximum from each layer
+            idx_inpt = get_max(inputs)
+            idx_otpt = get_max(outputs)
+
+            # calculate loss
+            loss = args.criterion(outputs, targets)
+        run_loss += loss.item()
+
+        if args.verbose and batch_idx == 1:
             print(outputs.shape)
-            idx_inpt = get_max(inputs, dim=(2, 3))
-            idx_otpt = get_max(outputs, dim=(2, 3))
             print(idx_inpt.shape)
             print(idx_inpt)
             print(idx_otpt.shape)
             print(idx_otpt)
-            input()
 
-            # calculate loss
-            loss = args.criterion(outputs, targets)
-            run_loss += loss.item()
-
-        if batch_idx < 10:
-            # Plot predictions
-            # img = imshow_bboxes(inputs, targets, args, t_outputs)
-            # args.writer.add_image('Test/predicted', img, batch_idx)
-            pass
-        else:
+        # Plot predictions
+        # img = imshow_bboxes(inputs, targets, args, t_outputs)
+        # args.writer.add_image('Test/predicted', img, batch_idx)
+        if batch_idx >= 10:
             break
 
 
@@ -316,6 +495,14 @@ def main():
     torch.set_printoptions(precision=2)
     torch.set_printoptions(edgeitems=5)
 
+    # Fixed input shape, let cuDNN pick the fastest kernels. Allow TF32
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    # Anomaly detection is slow, keep it for debugging
+    autograd.set_detect_anomaly(args.anomaly)
+
     # Set up GPU
     if args.device != 'cpu':
         args.device = torch.device('cuda:0'
@@ -329,13 +516,28 @@ def main():
     if args.checkpoint:
         read_checkpoint(args)
 
+    # Dataloader parameters (pinned memory only makes sense on GPU)
+    args.pin_memory = torch.device(args.device).type == 'cuda'
+    args.persistent_workers = args.num_workers > 0
+    args.prefetch_factor = 4 if args.num_workers > 0 else None
+
+    # Mixed precision only on GPU, bfloat16 when supported since it
+    # needs no loss scaling
+    args.amp = torch.device(args.device).type == 'cuda'
+    args.amp_dtype = torch.float16
+    if args.amp and torch.cuda.is_bf16_supported():
+        args.amp_dtype = torch.bfloat16
+
+    # Precompute frozen resnet features for training
+    args.cache_features = args.cache_features and not args.predict
+
     # Save parameters in string to name the execution
     args.run = create_run_name(args)
 
     # print run name
     print('execution name : {}'.format(args.run))
 
-    if args.predict is None:
+    if not args.predict:
         # Tensorboard summary writer
         writer = SummaryWriter('runs/' + args.run)
 
@@ -352,6 +554,17 @@ def main():
     pprint(args.hparams)
     print()
 
+    # Runtime objects are created after hparams, so none of them end up
+    # in the hparams saved with (and restored from) checkpoints
+    if not args.predict:
+        # Tensorboard images are written on a background thread
+        args.tensorboard_pool = ThreadPoolExecutor(max_workers=1)
+        args.tensorboard_futures = []
+        args.writer_lock = threading.Lock()
+
+        # Device buffers for tensorboard heatmaps
+        args.heatmap_buffers = {}
+
     # Create network
     if args.network == 'posture':
         net = Resnet_Posture(args)
@@ -362,6 +575,38 @@ def main():
 
     # Send networks to device
     args.net = net.to(args.device)
+    args.net = args.net.to(memory_format=torch.channels_last)
+
+    # Restore weights before the resnet features are cached
+    restore_weights(args)
+
+    # Compile network (in place, keeps state dict keys for checkpoints)
+    if args.compile:
+        args.net.compile(mode='reduce-overhead', fullgraph=False)
+
+        # Warm up compilation in the modes that will run: training
+        # (forward + backward) and eval + inference mode (validation and
+        # prediction). Keep weights and batchnorm statistics
+        state = copy.deepcopy(args.net.state_dict())
+        dummy = torch.randn(args.batch_size, 3, *args.image_shape,
+                            device=args.device)
+        if args.cache_features:
+            with torch.no_grad():
+                dummy = args.net.features(dummy)
+        dummy = dummy.contiguous(memory_format=torch.channels_last)
+        for training in ([False] if args.predict else [True, False]):
+            args.net.train(training)
+            for _ in range(3):
+                with torch.inference_mode(not training), \
+                     torch.amp.autocast('cuda', enabled=args.amp,
+                                        dtype=args.amp_dtype):
+                    outputs = args.net(dummy)
+                if training:
+                    outputs.float().mean().backward()
+        for param in args.net.parameters():
+            param.grad = None
+        args.net.load_state_dict(state)
+        args.net.train()
 
     # number of parameters
     total_params = sum(p.numel()
@@ -373,12 +618,28 @@ def main():
         print(args.net)
         return
 
+    # Precompute frozen resnet features
+    if args.cache_features:
+        trn = cache_features(trn, args)
+        vld = cache_features(vld, args)
+
     if args.predict:
         # Predict test
         predict_test(tst)
     else:
+        # Validation loader, reused by every validation
+        args.valid_loader = torch.utils.data.DataLoader(
+            vld,
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_memory,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
+            drop_last=False)
+
         # Train network
-        train(trn, vld)
+        train(trn)
 
     # (compatibility issues) Add hparams with metrics to tensorboard
     # args.writer.add_hparams(args.hparams, {'metrics': 0})
@@ -387,8 +648,10 @@ def main():
     del args.net
     torch.cuda.empty_cache()
 
-    if args.predict is None:
-        # Close tensorboard writer
+    if not args.predict:
+        # Wait for pending images and close tensorboard writer
+        wait_tensorboard()
+        args.tensorboard_pool.shutdown(wait=True)
         args.writer.close()
 
 
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
 import torch
+import hashlib
 import warnings
+import numpy as np
 from datetime import datetime
+from dataclasses import dataclass
 from sklearn.exceptions import UndefinedMetricWarning
 
 # Import network
@@ -12,17 +16,159 @@ from datasets import *
 warnings.filterwarnings(action='ignore', category=UndefinedMetricWarning)
 
 
-def get_max(x, dim=(2, 3)):
-    b = x.shape[0]
-    j = x.shape[1]
-    d = x.shape[2]
-    m = x.view(b, j, -1).argmax(1)
-    indices = torch.cat(((m // d).view(-1, 1),
-                         (m % d).view(-1, 1)),
-                        dim=1)
+@torch.jit.script
+def get_max(x: torch.Tensor) -> torch.Tensor:
+    # Peak (row, column) of each channel, shape [batch, channels, 2]
+    w = x.shape[-1]
+    _, m = x.flatten(start_dim=2).max(dim=-1)
+    indices = torch.stack((torch.div(m, w, rounding_mode='floor'),
+                           torch.remainder(m, w)), dim=-1)
     return indices
 
 
+@dataclass
+class TrainState():
+    # Training statistics, losses are kept on device
+    running_loss: torch.Tensor
+    train_loss: torch.Tensor
+    step: int = 0
+    valid_loss: float = float('nan')
+    best: float = float('inf')
+
+    def update(self, loss):
+        # Accumulate without synchronizing and advance the global step
+        self.running_loss += loss.detach()
+        self.train_loss += loss.detach()
+        self.step += 1
+
+
+class CUDAPrefetcher():
+    # Copy batch N+1 to the device on a side stream while batch N computes
+    def __init__(self, loader, device):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = None
+        if torch.device(device).type == 'cuda':
+            self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+
+        if self.stream is None:
+            self.batch = [t.to(self.device) for t in batch]
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.batch = [t.to(self.device, non_blocking=True) for t in batch]
+
+    def next(self):
+        batch = self.batch
+        if batch is None:
+            return None
+
+        if self.stream is not None:
+            # Wait for the copy and keep memory alive on the compute stream
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream())
+
+        # Start copying the next batch
+        self.preload()
+
+        return batch
+
+
+class BackwardOptimizer():
+    # One optimizer per parameter, stepped from a gradient hook so each
+    # gradient is consumed and freed right after backward produces it.
+    # Steps are never skipped, so it is not meant to be used with a
+    # GradScaler (float16 mixed precision)
+    def __init__(self, optimizer, params, **kwargs):
+        self.optimizers = {}
+        self.params = list(params)
+        for param in self.params:
+            if param.requires_grad:
+                self.optimizers[param] = optimizer([param], **kwargs)
+                param.register_post_accumulate_grad_hook(self.step)
+
+        # Updates run on a side stream, overlapping the rest of backward
+        self.stream = None
+        if any(param.is_cuda for param in self.optimizers):
+            self.stream = torch.cuda.Stream()
+
+    def step(self, param):
+        optimizer = self.optimizers[param]
+        if self.stream is None:
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            return
+
+        # Wait for the gradient, keep it alive until the update is done
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            param.grad.record_stream(self.stream)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+    def wait(self):
+        # Updated weights must be ready before they are read again
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+
+    def state_dict(self):
+        return [optimizer.state_dict()
+                for optimizer in self.optimizers.values()]
+
+    def load_state_dict(self, state_dict):
+        # A single optimizer state is split into one state per parameter
+        if not isinstance(state_dict, list):
+            state_dict = split_optimizer_state(state_dict, self.params)
+
+        check_optimizer_states(state_dict, self.params)
+        for optimizer, state in zip(self.optimizers.values(), state_dict):
+            optimizer.load_state_dict(state)
+
+
+def check_optimizer_states(states, params):
+    # One state per trainable parameter, in parameters() order
+    trainable = sum(param.requires_grad for param in params)
+    if len(states) != trainable:
+        raise ValueError('checkpoint has {} per-parameter optimizer states, '
+                         'but there are {} trainable parameters'
+                         .format(len(states), trainable))
+
+
+def split_optimizer_state(state_dict, params):
+    # Single optimizer state (indexed by position in params) to one
+    # state per trainable parameter, as saved by a BackwardOptimizer
+    state, group = state_dict['state'], state_dict['param_groups'][0]
+    states = []
+    for index, param in enumerate(params):
+        if not param.requires_grad:
+            continue
+        states.append({'state': {0: state[index]} if index in state else {},
+                       'param_groups': [dict(group, params=[0])]})
+    return states
+
+
+def merge_optimizer_state(states, params):
+    # One state per trainable parameter to a single optimizer state
+    # over all params, the inverse of split_optimizer_state
+    check_optimizer_states(states, params)
+    trainable = [index for index, param in enumerate(params)
+                 if param.requires_grad]
+    state = {index: param_state['state'][0]
+             for index, param_state in zip(trainable, states)
+             if 0 in param_state['state']}
+    group = dict(states[0]['param_groups'][0], params=list(range(len(params))))
+    return {'state': state, 'param_groups': [group]}
+
+
 def load_dataset(args):
     # Initial parameters
     dataDir = 'coco'
@@ -56,6 +202,74 @@ def load_dataset(args):
     return trn, vld, tst
 
 
+def weights_hash(module):
+    # Short fingerprint of the weights (and buffers) of a module
+    digest = hashlib.sha1()
+    for key, value in module.state_dict().items():
+        digest.update(key.encode())
+        digest.update(value.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+def cache_features(dataset, args):
+    # Features of the whole original dataset, keyed by split, image
+    # shape, backbone, its weights and the precision they are computed in,
+    # so runs (and resumes) with the same backbone reuse the same file
+    original, _ = unwrap_subset(dataset)
+    split = os.path.basename(os.path.normpath(original.root))
+    dtype = str(args.amp_dtype if args.amp else torch.float32)
+    path = 'features/{}_{}x{}_{}_{}_{}.npy'.format(
+        split, *args.image_shape, args.net.backbone,
+        dtype.replace('torch.', ''), weights_hash(args.net.resnet))
+
+    # Reuse a complete cache
+    if os.path.exists(path) and \
+       len(np.load(path, mmap_mode='r')) == len(original):
+        print('Reading {} features from {}'.format(split, path))
+        return FeatureDataset(dataset, path)
+
+    # Create dataset loader
+    loader = torch.utils.data.DataLoader(original,
+                                         batch_size=args.batch_size,
+                                         shuffle=False,
+                                         num_workers=args.num_workers,
+                                         pin_memory=args.pin_memory,
+                                         drop_last=False)
+
+    # Features are stored on disk as float16
+    os.makedirs('features', exist_ok=True)
+    print('Caching {} features into {}'.format(split, path))
+
+    # Run the frozen resnet once over the dataset, into a temporary file
+    # so an interrupted pass is never taken as a complete cache
+    tmp_path = path + '.tmp'
+    args.net.resnet.eval()
+    features = None
+    start = 0
+    with torch.inference_mode():
+        for inputs, _ in loader:
+            inputs = inputs.to(args.device, non_blocking=True)
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+            with torch.amp.autocast('cuda', enabled=args.amp,
+                                    dtype=args.amp_dtype):
+                outputs = args.net.features(inputs)
+            outputs = outputs.half().cpu().numpy()
+
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    tmp_path, mode='w+', dtype=np.float16,
+                    shape=(len(original),) + outputs.shape[1:])
+
+            features[start:start + len(outputs)] = outputs
+            start += len(outputs)
+
+    features.flush()
+    del features
+    os.replace(tmp_path, path)
+
+    return FeatureDataset(dataset, path)
+
+
 def get_hparams(dictionary):
     hparams = {}
     for key, value in dictionary.items():
@@ -76,7 +290,9 @@ def read_checkpoint(args):
     print('Read weights from {}.'.format(args.checkpoint))
 
     # Discard hparams
-    discard = ['run', 'predict', 'checkpoint', 'summary']
+    discard = ['run', 'predict', 'checkpoint', 'summary', 'anomaly',
+               'compile', 'verbose', 'num_workers', 'cache_features',
+               'profile']
 
     # Restore past checkpoint
     hparams = checkpoint['hparams']
@@ -85,7 +301,7 @@ def read_checkpoint(args):
             args.__dict__[key] = value
 
 
-def restore_checkpoint(args):
+def restore_weights(args):
     if args.checkpoint == 'none':
         return
 
@@ -96,39 +312,87 @@ def restore_checkpoint(args):
     # Restore weights
     args.net.load_state_dict(checkpoint['net_state_dict'])
 
+
+def restore_checkpoint(args):
+    # Weights are restored earlier by restore_weights
+    if args.checkpoint == 'none':
+        return
+
+    # Load provided checkpoint
+    checkpoint = torch.load(args.checkpoint, map_location=args.device)
+    print('Restored training state from {}.'.format(args.checkpoint))
+
     if args.predict:
         # To do inference
         args.net.eval()
     else:
-        # Read optimizer parameters
-        args.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        # Read optimizer parameters (a list when saved by a
+        # BackwardOptimizer, a single state otherwise)
+        state = checkpoint['optimizer_state_dict']
+        if isinstance(state, list) and \
+           not isinstance(args.optimizer, BackwardOptimizer):
+            state = merge_optimizer_state(state, list(args.net.parameters()))
+        args.optimizer.load_state_dict(state)
+
+        # Read mixed precision loss scale (older checkpoints have none)
+        if checkpoint.get('scaler_state_dict'):
+            args.scaler.load_state_dict(checkpoint['scaler_state_dict'])
 
         # To continue training
         args.net.train()
 
 
-def process_checkpoint(loss, global_step, args):
+def snapshot(state):
+    # Host copy of a (nested) state dict, safe to save from another thread
+    if isinstance(state, torch.Tensor):
+        # .cpu() already copies device tensors, only host ones need a clone
+        if state.device.type == 'cpu':
+            return state.detach().clone()
+        return state.detach().cpu()
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def wait_checkpoints(args):
+    # Wait for pending writes, raising their errors
+    for future in args.checkpoint_futures:
+        future.result()
+    args.checkpoint_futures = []
+
+
+def process_checkpoint(loss, global_step, state, args):
+    # Previous writes must finish before taking a new snapshot
+    wait_checkpoints(args)
+
+    # Snapshot on this thread, write to disk on the checkpoint pool
+    checkpoint = snapshot({
+        'net_state_dict': args.net.state_dict(),
+        'optimizer_state_dict': args.optimizer.state_dict(),
+        'scaler_state_dict': args.scaler.state_dict(),
+        'hparams': args.hparams,
+    })
+
     # check if current batch had best generating fitness
     steps_before_best = 100
-    if loss < args.best and global_step > steps_before_best:
-        args.best = loss
+    if loss < state.best and global_step > steps_before_best:
+        state.best = loss
 
         # Save best checkpoint
-        torch.save({
-            'net_state_dict': args.net.state_dict(),
-            'optimizer_state_dict': args.optimizer.state_dict(),
-            'hparams': args.hparams,
-        }, "checkpoint/best_{}.pt".format(args.run))
+        args.checkpoint_futures.append(args.checkpoint_pool.submit(
+            torch.save, checkpoint,
+            "checkpoint/best_{}.pt".format(args.run)))
 
         # Write tensorboard statistics
-        args.writer.add_scalar('Best/loss', loss, global_step)
+        with args.writer_lock:
+            args.writer.add_scalar('Best/loss', loss, global_step)
 
     # Save current checkpoint
-    torch.save({
-        'net_state_dict': args.net.state_dict(),
-        'optimizer_state_dict': args.optimizer.state_dict(),
-        'hparams': args.hparams,
-    }, "checkpoint/last_{}.pt".format(args.run))
+    args.checkpoint_futures.append(args.checkpoint_pool.submit(
+        torch.save, checkpoint,
+        "checkpoint/last_{}.pt".format(args.run)))
 
 
 def create_run_name(args):